@@ -0,0 +1,115 @@
+"""
+Channel surgery for pruned ShuffleNetV2/SE/SLE models.
+
+Rebuilds the hidden layers of BasicBlock/DownBlock branches and SE/SLE modules with fewer channels, and records or
+reapplies those channel counts so a pruned state dict can be loaded. Only depends on torch, so export.py and infer.py
+can use it without pulling in the pruning/reporting dependencies.
+"""
+
+
+import torch
+from torch import nn
+
+from shufflenet_alt import BasicBlock, DownBlock, SEBlock, SLEBlock
+
+
+# names of (conv in, bn in, depthwise conv, depthwise bn, conv out, bn out) for the prunable branch of each block
+branches = {
+    BasicBlock: ('conv1', 'bn1', 'conv2', 'bn2', 'conv3', 'bn3'),
+    DownBlock: ('conv3', 'bn3', 'conv4', 'bn4', 'conv5', 'bn5'),
+}
+
+# name of the sequential, and indices of (conv in, activation, conv out) for the hidden layer of each gate module
+gate_modules = {
+    SEBlock: ('se_block', 1, 2, 3),
+    SLEBlock: ('main', 1, 2, 3),
+}
+
+
+def _new_conv(conv, idx_out=None, idx_in=None):
+    weight = conv.weight.detach()
+    bias = conv.bias.detach() if conv.bias is not None else None
+    groups = conv.groups
+    if idx_out is not None:
+        weight = weight[idx_out]
+        bias = bias[idx_out] if bias is not None else None
+        if groups > 1:  # depthwise
+            groups = len(idx_out)
+    if idx_in is not None and conv.groups == 1:
+        weight = weight[:, idx_in]
+    new = nn.Conv2d(weight.size(1) * groups, weight.size(0), conv.kernel_size, stride=conv.stride,
+                    padding=conv.padding, groups=groups, bias=bias is not None,
+                    device=weight.device, dtype=weight.dtype)
+    with torch.no_grad():
+        new.weight.copy_(weight)
+        if bias is not None:
+            new.bias.copy_(bias)
+    return new
+
+
+def _new_bn(bn, idx):
+    new = nn.BatchNorm2d(len(idx), eps=bn.eps, momentum=bn.momentum,
+                         device=bn.weight.device, dtype=bn.weight.dtype)
+    with torch.no_grad():
+        new.weight.copy_(bn.weight[idx])
+        new.bias.copy_(bn.bias[idx])
+        new.running_mean.copy_(bn.running_mean[idx])
+        new.running_var.copy_(bn.running_var[idx])
+        new.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return new.train(bn.training)
+
+
+def prune_branch(block, idx):
+    """
+    Rebuilds the branch of a BasicBlock/DownBlock so it only keeps the hidden channels in idx.
+    """
+    conv_in, bn_in, conv_dw, bn_dw, conv_out, _ = branches[type(block)]
+    idx = idx.to(getattr(block, conv_in).weight.device)
+    setattr(block, conv_in, _new_conv(getattr(block, conv_in), idx_out=idx))
+    setattr(block, bn_in, _new_bn(getattr(block, bn_in), idx))
+    setattr(block, conv_dw, _new_conv(getattr(block, conv_dw), idx_out=idx))
+    setattr(block, bn_dw, _new_bn(getattr(block, bn_dw), idx))
+    setattr(block, conv_out, _new_conv(getattr(block, conv_out), idx_in=idx))
+
+
+def prune_gate(module, idx):
+    """
+    Rebuilds the hidden layer of an SE/SLE module so it only keeps the channels in idx.
+    """
+    seq_name, conv_in, _, conv_out = gate_modules[type(module)]
+    seq = getattr(module, seq_name)
+    idx = idx.to(seq[conv_in].weight.device)
+    seq[conv_in] = _new_conv(seq[conv_in], idx_out=idx)
+    seq[conv_out] = _new_conv(seq[conv_out], idx_in=idx)
+    if isinstance(module, SEBlock):
+        module.mid_channels = len(idx)
+
+
+def hidden_channels(module):
+    if type(module) in branches:
+        return getattr(module, branches[type(module)][0]).out_channels
+    seq_name, conv_in, _, _ = gate_modules[type(module)]
+    return getattr(module, seq_name)[conv_in].out_channels
+
+
+def get_channel_config(model):
+    """
+    :return: dict mapping module name to the number of hidden channels, for every prunable module
+    """
+    return {name: hidden_channels(m) for name, m in model.named_modules()
+            if type(m) in branches or type(m) in gate_modules}
+
+
+def set_channel_config(model, config):
+    """
+    Shrinks a freshly built model to the shapes in config so a pruned state dict can be loaded into it.
+    """
+    modules = dict(model.named_modules())
+    for name, channels in config.items():
+        m = modules[name]
+        idx = torch.arange(channels)
+        if type(m) in branches:
+            prune_branch(m, idx)
+        else:
+            prune_gate(m, idx)
+    return model
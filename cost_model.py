@@ -0,0 +1,260 @@
+"""
+Analytic parameter/MAC/activation memory estimates for ShuffleNetV2, SE and SLE, straight from the configs table.
+
+Every layer contributes a fixed number of params and a MAC/activation count that is linear in the number of spatial
+positions at its resolution level(input, then after each of the three DownBlocks). So each net and net_size reduces
+to one coefficient vector per quantity, and a whole grid of net_size x resolution x batch is a single matrix product.
+MACs follow ptflops' counting rules(convs, BN, ReLU, pools and linear layers, sigmoids and elementwise products are
+free) so the numbers line up with util.get_params_info. ptflops>=0.7 counts nn.ReLU and nn.AdaptiveAvgPool2d twice
+(the module hook and the patched functional both fire), pass ptflops=True to reproduce that. The head is treated as a
+global average pool. That's what F.avg_pool2d(out, 4) does when the final feature map is 4-7 px(input 25-56 px),
+anything else leaves linear with the wrong number of features, so those resolutions are reported as infeasible(NaN).
+"""
+
+
+import argparse
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from shufflenet_alt import configs
+
+# spatial levels: 0 = input resolution, 1-3 = after each DownBlock, 4 = fixed 1x1 outputs(gates, head)
+num_levels = 5
+const = 4
+
+
+def _new():
+    # dup: MACs that ptflops counts a second time
+    return {"params": 0, "macs": np.zeros(num_levels), "acts": np.zeros(num_levels), "dup": np.zeros(num_levels)}
+
+
+def _conv(c, level, cin, cout, k=1, groups=1, bias=False):
+    c["params"] += k * k * cin * cout // groups + (cout if bias else 0)
+    c["macs"][level] += k * k * cin * cout // groups + (cout if bias else 0)
+    c["acts"][level] += cout
+
+
+def _bn(c, level, ch):
+    c["params"] += 2 * ch
+    c["macs"][level] += 2 * ch
+    c["acts"][level] += ch
+
+
+def _relu(c, level, ch):
+    c["macs"][level] += ch
+    c["acts"][level] += ch
+
+
+def _basic_block(c, level, ch):
+    h = ch // 2
+    _conv(c, level, h, h)
+    _bn(c, level, h)
+    _relu(c, level, h)
+    _conv(c, level, h, h, k=3, groups=h)
+    _bn(c, level, h)
+    _conv(c, level, h, h)
+    _bn(c, level, h)
+    _relu(c, level, h)
+    c["acts"][level] += 2 * ch  # cat, shuffle
+
+
+def _down_block(c, level, cin, cout):
+    mid = cout // 2
+    # left
+    _conv(c, level + 1, cin, cin, k=3, groups=cin)
+    _bn(c, level + 1, cin)
+    _conv(c, level + 1, cin, mid)
+    _bn(c, level + 1, mid)
+    _relu(c, level + 1, mid)
+    # right
+    _conv(c, level, cin, mid)
+    _bn(c, level, mid)
+    _relu(c, level, mid)
+    _conv(c, level + 1, mid, mid, k=3, groups=mid)
+    _bn(c, level + 1, mid)
+    _conv(c, level + 1, mid, mid)
+    _bn(c, level + 1, mid)
+    _relu(c, level + 1, mid)
+    c["acts"][level + 1] += 2 * cout  # cat, shuffle
+
+
+def _se_block(c, level, ch, reduction):
+    mid = ch // reduction
+    c["macs"][level] += ch  # pool
+    c["dup"][level] += ch
+    c["acts"][const] += ch
+    _conv(c, const, ch, mid, bias=True)
+    _relu(c, const, mid)
+    c["dup"][const] += mid
+    _conv(c, const, mid, ch, bias=True)
+    c["acts"][const] += ch  # sigmoid
+    c["acts"][level] += ch  # gate * x
+
+
+def _sle_block(c, level_small, level_big, ch_in, ch_out):
+    c["macs"][level_small] += ch_in  # pool
+    c["dup"][level_small] += ch_in
+    c["acts"][const] += 16 * ch_in
+    _conv(c, const, ch_in, ch_out, k=4)
+    c["acts"][const] += 2 * ch_out  # swish
+    _conv(c, const, ch_out, ch_out)
+    c["acts"][const] += ch_out  # sigmoid
+    c["acts"][level_big] += ch_out  # gate * feat
+
+
+@lru_cache(maxsize=None)
+def coefficients(net, net_size):
+    """
+    :param net: base/se/sle
+    :return: (params, macs, acts, dup), per-level coefficients except params, multiply by positions at each level
+    """
+    out_channels = configs[net_size]['out_channels']
+    num_blocks = configs[net_size]['num_blocks']
+    c = _new()
+    c["acts"][0] += 3  # input
+    _conv(c, 0, 3, 24, k=3)
+    _bn(c, 0, 24)
+    _relu(c, 0, 24)
+    if net == "se":
+        _se_block(c, 0, 24, 1)
+
+    in_channels = 24
+    for stage in range(3):
+        _down_block(c, stage, in_channels, out_channels[stage])
+        if net == "se":
+            _se_block(c, stage + 1, out_channels[stage], [4, 8, 16][stage])
+        for _ in range(num_blocks[stage]):
+            _basic_block(c, stage + 1, out_channels[stage])
+        if net == "se":
+            _se_block(c, stage + 1, out_channels[stage], [4, 8, 16][stage])
+        if net == "sle":
+            _sle_block(c, stage, stage + 1, in_channels, out_channels[stage])
+        in_channels = out_channels[stage]
+
+    _conv(c, 3, out_channels[2], out_channels[3])
+    _bn(c, 3, out_channels[3])
+    _relu(c, 3, out_channels[3])
+    if net == "se":
+        _se_block(c, 3, out_channels[3], 16)
+    c["macs"][3] += out_channels[3]  # avg pool
+    c["acts"][const] += out_channels[3]
+    c["params"] += out_channels[3] * 10 + 10
+    c["macs"][const] += out_channels[3] * 10 + 10
+    c["acts"][const] += 10
+    return c["params"], c["macs"], c["acts"], c["dup"]
+
+
+def _sides(res):
+    sides = [np.asarray(res, dtype=np.int64)]
+    for _ in range(3):
+        sides.append((sides[-1] + 1) // 2)  # 3x3, stride 2, padding 1
+    return sides
+
+
+def positions(res):
+    """
+    :param res: array of input resolutions(square)
+    :return: num_levels x len(res) array of spatial positions at each level
+    """
+    sides = _sides(res)
+    sides.append(np.ones_like(sides[0]))
+    return np.stack(sides) ** 2
+
+
+def feasible(res):
+    """
+    :param res: array of input resolutions(square)
+    :return: mask of resolutions the models can run at, F.avg_pool2d(out, 4) has to leave a 1x1 map for linear
+    """
+    return _sides(res)[-1] // 4 == 1
+
+
+def estimate(net="base", net_sizes=(0.5, 1, 1.5, 2), res=(32,), batch=(1,), bytes_per_element=4, ptflops=False):
+    """
+    Estimates cost for every combination of net_size, resolution and batch size.
+
+    :param ptflops: include the MACs ptflops double counts
+    :return: dict with arrays of shape len(net_sizes) x len(res) x len(batch):
+        Parameters, MMac(per image, like ptflops), Activations(bytes for the whole batch, every intermediate tensor),
+        all NaN where the resolution isn't feasible, and feasible
+    """
+    params, macs, acts, dup = zip(*(coefficients(net, s) for s in net_sizes))
+    macs = np.stack(macs) + np.stack(dup) if ptflops else np.stack(macs)
+    res = np.atleast_1d(res)
+    pos = positions(res)
+    batch = np.atleast_1d(batch).astype(np.float64)
+    shape = (len(net_sizes), pos.shape[1], len(batch))
+    ok = np.broadcast_to(feasible(res)[None, :, None], shape)
+    est = {"Parameters": np.broadcast_to(np.array(params, dtype=np.float64)[:, None, None], shape),
+           "MMac": np.broadcast_to((macs @ pos)[:, :, None], shape),
+           "Activations": (np.stack(acts) @ pos)[:, :, None] * batch[None, None, :] * bytes_per_element}
+    est = {k: np.where(ok, v, np.nan) for k, v in est.items()}
+    est["feasible"] = ok
+    return est
+
+
+def estimate_df(nets=("base", "se", "sle"), net_sizes=(0.5, 1, 1.5, 2), res=(32,), batch=(1,), bytes_per_element=4,
+                ptflops=False):
+    """
+    Same as estimate, as a long table with one row per net/net_size/resolution/batch.
+    """
+    res, batch = np.atleast_1d(res), np.atleast_1d(batch)
+    frames = []
+    for net in nets:
+        est = estimate(net, net_sizes, res, batch, bytes_per_element, ptflops)
+        idx = np.indices(est["Parameters"].shape).reshape(3, -1)
+        frames.append(pd.DataFrame({"Model": net,
+                                    "net_size": np.asarray(net_sizes)[idx[0]],
+                                    "resolution": res[idx[1]],
+                                    "batch_size": batch[idx[2]],
+                                    **{k: v.reshape(-1) for k, v in est.items()}}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def check(nets=("base", "se", "sle"), net_sizes=(0.5, 1, 1.5, 2), res=(32,)):
+    """
+    Compares the estimates to ptflops on the real models.
+    """
+    from ptflops import get_model_complexity_info
+    from shufflenet_alt import nets as models
+
+    ret = {"Model": [], "net_size": [], "resolution": [], "Parameters": [], "Parameters_ptflops": [],
+           "MMac": [], "MMac_ptflops": []}
+    for net in nets:
+        for net_size in net_sizes:
+            mod = models[net](net_size=net_size)
+            for r in res:
+                est = estimate(net, (net_size,), (r,), ptflops=True)
+                macs, params = np.nan, np.nan
+                # the model raises at infeasible resolutions
+                if est["feasible"].item():
+                    macs, params = get_model_complexity_info(mod, (3, r, r), as_strings=False,
+                                                             print_per_layer_stat=False, verbose=False)
+                ret["Model"].append(net)
+                ret["net_size"].append(net_size)
+                ret["resolution"].append(r)
+                ret["Parameters"].append(est["Parameters"].item())
+                ret["Parameters_ptflops"].append(params)
+                ret["MMac"].append(est["MMac"].item())
+                ret["MMac_ptflops"].append(macs)
+    return pd.DataFrame(ret)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--res", type=int, nargs="+", default=[32])
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[1])
+    parser.add_argument("--output", type=str, required=False, default=None)
+    parser.add_argument("--check", action="store_true", help="compare against ptflops")
+    parser.add_argument("--ptflops", action="store_true", help="count MACs the way ptflops does")
+    args = parser.parse_args()
+
+    if args.check:
+        print(check(res=args.res).to_string(index=False))
+    else:
+        d = estimate_df(res=args.res, batch=args.batch_size, ptflops=args.ptflops)
+        if args.output is not None:
+            d.to_csv(args.output, index=False)
+        print(d.to_string(index=False))
@@ -0,0 +1,77 @@
+"""
+Exports training checkpoints to a compact weights-only format for serving, and loads them without random init.
+
+The exported file is a regular torch zip checkpoint holding only the model state dict(optionally in fp16/bf16) and
+enough metadata to rebuild the model. torch.load(mmap=True) maps the tensors straight from the file, and the model
+is built on the meta device so load_state_dict(assign=True) just points the parameters at the mapped storage.
+"""
+
+
+import argparse
+import os
+import time
+
+import torch
+
+from shufflenet_alt import nets
+from channels import set_channel_config
+
+dtypes = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16
+}
+
+
+def export(checkpoint, outputpath, net=None, net_size=None, dtype='fp32'):
+    """
+    Writes the weights in checkpoint(NNNN.pth from train.py or prune.py) without the optimizer state.
+
+    :param net: base/se/sle, only needed if the checkpoint doesn't say
+    :param dtype: fp32/fp16/bf16, only floating point tensors are cast
+    """
+    ckpt = torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
+    net = ckpt.get("net", net)
+    net_size = ckpt.get("net_size", net_size if net_size is not None else 1)
+    assert net in nets, f"unknown net {net}, pass one of {list(nets)}"
+    state_dict = {k: v.to(dtypes[dtype]) if v.is_floating_point() else v
+                  for k, v in ckpt["mod"].items()}
+    torch.save({"mod": state_dict,
+                "net": net,
+                "net_size": net_size,
+                "channels": ckpt.get("channels", {})}, outputpath)
+
+
+def load_model(path, device="cpu", dtype=None):
+    """
+    Builds the model on the meta device and maps the exported weights into it.
+
+    :param dtype: cast the weights to this dtype(a copy), leave as None to keep the exported dtype
+    :return: model in eval mode
+    """
+    ckpt = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    with torch.device("meta"):
+        model = nets[ckpt["net"]](net_size=ckpt["net_size"])
+        set_channel_config(model, ckpt["channels"])
+    model.load_state_dict(ckpt["mod"], assign=True)
+    if dtype is not None:
+        model = model.to(dtype)
+    return model.to(device).eval()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True, help="NNNN.pth from train.py or prune.py")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--net", type=str, required=False, default=None, help="base/se/sle")
+    parser.add_argument("--net_size", type=float, required=False, default=None)
+    parser.add_argument("--dtype", type=str, required=False, default="fp32", help="fp32/fp16/bf16")
+    args = parser.parse_args()
+
+    export(args.checkpoint, args.output, net=args.net, net_size=args.net_size, dtype=args.dtype)
+    print(f"{args.checkpoint}: {os.path.getsize(args.checkpoint) / 2 ** 20:.2f} MB")
+    print(f"{args.output}: {os.path.getsize(args.output) / 2 ** 20:.2f} MB")
+
+    start_time = time.time()
+    model = load_model(args.output)
+    print(f"Loaded {model.__class__} in {time.time() - start_time:.4f} seconds")
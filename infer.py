@@ -0,0 +1,337 @@
+"""
+Streaming bulk inference from an image directory/manifest or a packed uint8 array to memory-mapped logits/top-k files.
+
+Pipeline: a producer thread hands batches to a pool of decode workers, a model thread runs the forward pass on
+finished batches, and the main thread writes results into preallocated .npy memmaps. Both queues are bounded, so
+memory stays constant no matter how many images there are and a slow stage holds back the ones before it.
+"""
+
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from shufflenet_alt import nets
+from export import load_model
+
+mean, std = (0.4914, 0.4822, 0.4465), (0.247, 0.243, 0.261)
+extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def write_manifest(root, path):
+    """
+    Walks root once and writes every image path to path, one per line, in sorted order so offsets are stable
+    between runs. Only one directory listing is held in memory at a time.
+    """
+    root = os.path.abspath(root)
+    # the old line index doesn't describe the new file
+    if os.path.isfile(f"{path}.idx"):
+        os.remove(f"{path}.idx")
+    with open(path, "w") as f:
+        for d, dirs, files in os.walk(root):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(extensions):
+                    f.write(os.path.join(d, name) + "\n")
+
+
+def index_manifest(path, chunk_size=2 ** 24):
+    """
+    Writes the byte offset of every line in the manifest to path.idx(raw int64), after a header with the manifest's
+    size and mtime(ns). The index is rebuilt unless both still match.
+
+    :return: memmap of the offsets
+    """
+    idx_path = f"{path}.idx"
+    st = os.stat(path)
+    header = np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+    if not os.path.isfile(idx_path) or \
+            not np.array_equal(np.fromfile(idx_path, dtype=np.int64, count=len(header)), header):
+        size = st.st_size
+        with open(path, "rb") as f, open(idx_path, "wb") as out:
+            header.tofile(out)
+            if size > 0:
+                np.zeros(1, dtype=np.int64).tofile(out)
+            pos = 0
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                starts = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n")) + pos + 1
+                starts[starts < size].astype(np.int64).tofile(out)
+                pos += len(chunk)
+    if os.path.getsize(idx_path) == header.nbytes:
+        return np.zeros(0, dtype=np.int64)
+    return np.memmap(idx_path, dtype=np.int64, mode="r", offset=header.nbytes)
+
+
+class ManifestSource:
+    """
+    Images listed in a manifest file, one path per line(relative paths are relative to the manifest). Paths are read
+    by offset through an on-disk line index, so memory doesn't grow with the number of images.
+    """
+    def __init__(self, path, size=32):
+        self.offsets = index_manifest(path)
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.file_size = os.path.getsize(path)
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __del__(self):
+        os.close(self.fd)
+
+    def paths(self, start, end):
+        lo = int(self.offsets[start])
+        hi = int(self.offsets[end]) if end < len(self.offsets) else self.file_size
+        lines = os.pread(self.fd, hi - lo, lo).decode().splitlines()
+        return [os.path.join(self.root, p) for p in lines]
+
+    def _decode(self, path):
+        with Image.open(path) as img:
+            return np.asarray(img.convert('RGB').resize((self.size, self.size), Image.BILINEAR))
+
+    def batch(self, start, end):
+        """
+        :return: (images, failed), unreadable images are left as zeros and flagged in failed
+        """
+        images = np.zeros((end - start, self.size, self.size, 3), dtype=np.uint8)
+        failed = np.zeros(end - start, dtype=bool)
+        for i, p in enumerate(self.paths(start, end)):
+            try:
+                images[i] = self._decode(p)
+            except Exception:
+                failed[i] = True
+        return images, failed
+
+
+class ArraySource:
+    """
+    Packed .npy array of uint8 images, N x H x W x 3, read through a memmap.
+    """
+    def __init__(self, path):
+        self.data = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.data)
+
+    def batch(self, start, end):
+        return np.array(self.data[start:end]), np.zeros(end - start, dtype=bool)
+
+
+def get_source(path, size=32, manifest=None, reuse=False):
+    """
+    :param path: image directory, manifest file(one path per line) or packed .npy
+    :param manifest: where to write the manifest for a directory, its root is stored next to it in manifest.root
+    :param reuse: keep an existing manifest instead of walking the directory again(--resume/--offset), it has to
+        have been written for the same directory
+    """
+    if os.path.isdir(path):
+        manifest = manifest or os.path.join(path, "manifest.txt")
+        root = os.path.abspath(path)
+        root_path = f"{manifest}.root"
+        if reuse and os.path.isfile(manifest):
+            old_root = open(root_path).read() if os.path.isfile(root_path) else None
+            assert old_root == root, f"{manifest} was written for {old_root}, not {root}, can't resume"
+        else:
+            write_manifest(root, manifest)
+            with open(root_path, "w") as f:
+                f.write(root)
+        return ManifestSource(manifest, size=size)
+    if path.endswith(".npy"):
+        return ArraySource(path)
+    return ManifestSource(path, size=size)
+
+
+def get_model(checkpoint, net=None, net_size=1, device="cpu"):
+    """
+    Loads either an export.py/prune.py checkpoint(which know their own net) or a train.py one(needs net).
+
+    Exported fp16/bf16 weights are kept as they are(no copy), except fp16 on CPU which is upcast to fp32.
+    """
+    ckpt = torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
+    if "net" in ckpt:
+        fp16 = any(v.dtype == torch.float16 for v in ckpt["mod"].values())
+        dtype = torch.float32 if fp16 and device == "cpu" else None
+        return load_model(checkpoint, device=device, dtype=dtype)
+    assert net in nets, f"unknown net {net}, pass one of {list(nets)}"
+    model = nets[net](net_size=net_size)
+    model.load_state_dict(ckpt["mod"])
+    return model.to(device).eval()
+
+
+def open_outputs(prefix, n, num_classes, k, resume):
+    """
+    Preallocates the output .npy files, or reopens them when resuming.
+    """
+    mode = 'r+' if resume and os.path.isfile(f"{prefix}_logits.npy") else 'w+'
+    logits = np.lib.format.open_memmap(f"{prefix}_logits.npy", mode=mode, dtype=np.float32, shape=(n, num_classes))
+    topk = np.lib.format.open_memmap(f"{prefix}_topk.npy", mode=mode, dtype=np.int64, shape=(n, k))
+    assert logits.shape == (n, num_classes) and topk.shape == (n, k), "existing outputs don't match the input"
+    return logits, topk
+
+
+def _put(q, item, stop):
+    # blocks while the next stage is behind, gives up once run() has stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _producer(source, pool, batches, offset, batch_size, stop):
+    for start in range(offset, len(source), batch_size):
+        end = min(start + batch_size, len(source))
+        if stop.is_set():
+            return
+        if not _put(batches, (start, pool.submit(source.batch, start, end)), stop):
+            return
+    _put(batches, None, stop)
+
+
+def _model_worker(model, device, batches, results, k, stop):
+    norm_mean = torch.tensor(mean, device=device).view(1, 3, 1, 1)
+    norm_std = torch.tensor(std, device=device).view(1, 3, 1, 1)
+    dtype = next(model.parameters()).dtype
+    try:
+        with torch.no_grad():
+            while not stop.is_set():
+                try:
+                    item = batches.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                start, fut = item
+                wait_start = time.time()
+                images, failed = fut.result()
+                wait_time = time.time() - wait_start
+
+                model_start = time.time()
+                inputs = torch.from_numpy(images).to(device).permute(0, 3, 1, 2).float().div_(255)
+                inputs = ((inputs - norm_mean) / norm_std).to(dtype)
+                outputs = model(inputs).float()
+                _, top = torch.topk(outputs, k=k, dim=1)
+                outputs, top = outputs.cpu().numpy(), top.cpu().numpy()
+                # sentinel rows for images that couldn't be decoded
+                outputs[failed] = np.nan
+                top[failed] = -1
+                _put(results, (start, outputs, top, failed.sum(), wait_time, time.time() - model_start), stop)
+    except Exception as e:
+        _put(results, e, stop)
+        return
+    _put(results, None, stop)
+
+
+def run(source, model, device, prefix, batch_size=256, k=3, workers=None, prefetch=None,
+        offset=0, resume=False, log_every=100):
+    """
+    Scores every image in source from offset onwards.
+
+    :param offset: index of the first image to score, earlier results in existing outputs are kept
+    :param resume: continue from the progress file of an earlier run
+    :param workers: decode threads, defaults to the number of cores
+    :param prefetch: max batches in flight between decode and model, defaults to 2 * workers
+    :return: dict of throughput stats, failed counts images that couldn't be decoded(NaN logits, -1 top-k)
+    """
+    workers = workers or os.cpu_count()
+    prefetch = prefetch or 2 * workers
+    n = len(source)
+    logits, topk = open_outputs(prefix, n, model.linear.out_features, k, resume or offset > 0)
+    progress_path = f"{prefix}_progress.json"
+    if resume and offset == 0 and os.path.isfile(progress_path):
+        with open(progress_path) as f:
+            offset = json.load(f)["done"]
+    print(f"Scoring {n - offset} of {n} images, starting at {offset}")
+
+    batches = queue.Queue(maxsize=prefetch)
+    results = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    threads = [threading.Thread(target=_producer, args=(source, pool, batches, offset, batch_size, stop), daemon=True),
+               threading.Thread(target=_model_worker, args=(model, device, batches, results, k, stop), daemon=True)]
+    for t in threads:
+        t.start()
+
+    stats = {"images": 0, "failed": 0, "batches": 0, "decode_wait": 0.0, "model_time": 0.0}
+    start_time = time.time()
+    try:
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            start, outputs, top, failed, wait_time, model_time = item
+            end = start + len(outputs)
+            logits[start:end] = outputs
+            topk[start:end] = top
+
+            stats["images"] += len(outputs)
+            stats["failed"] += int(failed)
+            stats["batches"] += 1
+            stats["decode_wait"] += wait_time
+            stats["model_time"] += model_time
+            if stats["batches"] % log_every == 0:
+                logits.flush()
+                topk.flush()
+                with open(progress_path, "w") as f:
+                    json.dump({"done": end}, f)
+                elapsed = time.time() - start_time
+                print(f"{end} / {n}, {stats['images'] / elapsed:.2f} images/s")
+    finally:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+        for t in threads:
+            t.join(timeout=1)
+    logits.flush()
+    topk.flush()
+    with open(progress_path, "w") as f:
+        json.dump({"done": n}, f)
+
+    elapsed = time.time() - start_time
+    stats["time"] = elapsed
+    stats["images_per_second"] = stats["images"] / elapsed if elapsed > 0 else 0.0
+    stats["batches_per_second"] = stats["batches"] / elapsed if elapsed > 0 else 0.0
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True,
+                        help="image directory, manifest(one path per line) or packed .npy(N x H x W x 3)")
+    parser.add_argument("--output", type=str, required=True, help="prefix for the _logits.npy/_topk.npy files")
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--net", type=str, required=False, default=None, help="base/se/sle, for train.py checkpoints")
+    parser.add_argument("--net_size", type=float, required=False, default=1)
+    parser.add_argument("--batch_size", type=int, required=False, default=256)
+    parser.add_argument("--topk", type=int, required=False, default=3)
+    parser.add_argument("--size", type=int, required=False, default=32, help="images are resized to size x size")
+    parser.add_argument("--workers", type=int, required=False, default=None)
+    parser.add_argument("--prefetch", type=int, required=False, default=None)
+    parser.add_argument("--offset", type=int, required=False, default=0)
+    parser.add_argument("--resume", action="store_true", help="reuse existing outputs, continue from progress file")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(device)
+
+    model = get_model(args.checkpoint, net=args.net, net_size=args.net_size, device=device)
+    source = get_source(args.input, size=args.size, manifest=f"{args.output}_manifest.txt",
+                        reuse=args.resume or args.offset > 0)
+    stats = run(source, model, device, args.output, batch_size=args.batch_size, k=args.topk,
+                workers=args.workers, prefetch=args.prefetch, offset=args.offset, resume=args.resume)
+    print(stats)
@@ -0,0 +1,147 @@
+"""
+Optimizer and LR scheduler setup for train.py.
+
+Adam/AdamW use the fused kernel when the device supports it and the foreach kernel otherwise. With flat=True every
+parameter is moved into one contiguous buffer(and every grad into another), so the optimizer steps a single tensor
+instead of looping over ~150 small ones. LR decay is done by schedulers on the same optimizer, so Adam's moment
+estimates are kept across decays.
+"""
+
+
+import torch
+import torch.optim as optim
+
+optimizers = {
+    'adam': optim.Adam,
+    'adamw': optim.AdamW
+}
+
+
+class FlatParams:
+    """
+    Copies the parameters into one contiguous buffer and points each of them at its slice. Their grads are views into
+    a second buffer, autograd accumulates into them in place, so the flat parameter always has the full gradient.
+    """
+    def __init__(self, params):
+        params = [p for p in params if p.requires_grad]
+        n = sum(p.numel() for p in params)
+        self.param = torch.nn.Parameter(torch.empty(n, device=params[0].device, dtype=params[0].dtype))
+        self.param.grad = torch.zeros_like(self.param)
+        self.params = params
+        self.offsets = []
+        offset = 0
+        with torch.no_grad():
+            for p in params:
+                k = p.numel()
+                self.param[offset:offset + k].copy_(p.flatten())
+                p.data = self.param.data[offset:offset + k].view_as(p)
+                p.grad = self.param.grad[offset:offset + k].view_as(p)
+                self.offsets.append(offset)
+                offset += k
+
+    def relink(self):
+        """
+        Makes sure every grad is a view into the flat grad buffer again. model.zero_grad() sets them to None, and the
+        next backward then writes into a fresh tensor, so those grads are copied back in.
+
+        Raises if a parameter itself no longer points into the flat buffer(e.g. model.to()/.half() after the
+        optimizer was built), since the optimizer would silently stop updating it.
+        """
+        if self.param.grad is None:
+            raise RuntimeError("flat grad buffer was cleared, use FlatOptimizer.zero_grad")
+        size = self.param.element_size()
+        for p, offset in zip(self.params, self.offsets):
+            if p.dtype != self.param.dtype or p.data_ptr() != self.param.data_ptr() + offset * size:
+                raise RuntimeError("parameters were moved out of the flat buffer(model.to()/.half() after "
+                                   "get_optimizer?), build the optimizer again")
+            grad = self.param.grad[offset:offset + p.numel()]
+            if p.grad is None:
+                grad.zero_()
+                p.grad = grad.view_as(p)
+            elif p.grad.data_ptr() != grad.data_ptr():
+                grad.copy_(p.grad.flatten())
+                p.grad = grad.view_as(p)
+
+    @staticmethod
+    def supported(params):
+        params = [p for p in params if p.requires_grad]
+        return len(params) > 0 and len({(p.device, p.dtype) for p in params}) == 1
+
+
+class FlatOptimizer:
+    """
+    Wraps an optimizer over a FlatParams buffer. zero_grad clears the grad buffer in place instead of setting it to
+    None, since the model's grads are views into it.
+    """
+    def __init__(self, optimizer, flat):
+        self.optimizer = optimizer
+        self.flat = flat
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    def zero_grad(self, set_to_none=False):
+        self.flat.param.grad.zero_()
+
+    def step(self, closure=None):
+        self.flat.relink()
+        return self.optimizer.step(closure)
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict)
+
+
+def _make(cls, params, **kwargs):
+    # fused isn't available for every device/dtype/torch version, foreach always is
+    try:
+        return cls(params, fused=True, **kwargs)
+    except (RuntimeError, TypeError):
+        return cls(params, foreach=True, **kwargs)
+
+
+def get_optimizer(model, name="adam", lr=1e-3, betas=(0.9, 0.999), weight_decay=0, flat=True):
+    """
+    :param name: adam/adamw
+    :param flat: put all parameters in one buffer, if they share a device and dtype
+    """
+    if name not in optimizers:
+        raise ValueError(f"unknown optimizer {name}, pass one of {list(optimizers)}")
+    params = list(model.parameters())
+    if flat and FlatParams.supported(params):
+        flat_params = FlatParams(params)
+        optimizer = _make(optimizers[name], [flat_params.param], lr=lr, betas=betas, weight_decay=weight_decay)
+        return FlatOptimizer(optimizer, flat_params)
+    return _make(optimizers[name], params, lr=lr, betas=betas, weight_decay=weight_decay)
+
+
+def get_scheduler(optimizer, name="step", epochs=100, lr_decay_rate=10, lr_decay_epochs=(), decay_patience=10,
+                  warmup_epochs=0):
+    """
+    Schedulers are stepped once at the end of every epoch.
+
+    :param name: step/plateau/cosine/none
+        step: divide lr by lr_decay_rate after each epoch in lr_decay_epochs
+        plateau: divide lr by lr_decay_rate when training loss hasn't improved for decay_patience epochs
+        cosine: linear warmup for warmup_epochs, then cosine decay to 0 at epochs
+    """
+    optimizer = getattr(optimizer, "optimizer", optimizer)
+    if name == "step":
+        # the old loop decayed after epoch i, for i > 0, so the new lr applies from epoch i + 1
+        milestones = [e + 1 for e in lr_decay_epochs if e > 0]
+        return optim.lr_scheduler.MultiStepLR(optimizer, milestones=milestones, gamma=1 / lr_decay_rate)
+    if name == "plateau":
+        return optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=1 / lr_decay_rate, patience=decay_patience)
+    if name == "cosine":
+        cosine = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(1, epochs - warmup_epochs))
+        if warmup_epochs == 0:
+            return cosine
+        warmup = optim.lr_scheduler.LinearLR(optimizer, start_factor=1 / (warmup_epochs + 1),
+                                             total_iters=warmup_epochs)
+        return optim.lr_scheduler.SequentialLR(optimizer, [warmup, cosine], milestones=[warmup_epochs])
+    if name == "none":
+        return None
+    raise ValueError(f"unknown scheduler {name}, pass one of step/plateau/cosine/none")
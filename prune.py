@@ -0,0 +1,282 @@
+"""
+Gate-driven structured channel pruning for ShuffleNetV2, SE and SLE.
+
+The sigmoid gates in SEBlock/SLEBlock are averaged over a calibration set and used to score the hidden channels
+of the pointwise convs in BasicBlock and DownBlock. Block outputs are never touched, so the SplitBlock/ShuffleBlock
+channel pairing still lines up, only the channels inside each branch (and inside the gate modules) are removed.
+"""
+
+
+import argparse
+import math
+import time
+
+import pandas as pd
+import torch
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+from torch import nn
+from torch.utils.data import DataLoader, Subset
+from ptflops import get_model_complexity_info
+
+from shufflenet_alt import BasicBlock, SEBlock, nets
+from channels import branches, gate_modules, prune_branch, prune_gate, get_channel_config, set_channel_config
+from util import top1_error
+
+
+def collect_stats(model, loader, device, num_batches=None):
+    """
+    Runs the calibration set through the model and averages the output of every gate module.
+
+    :return: (gates, hidden) dicts, mapping each SE/SLE module to its mean gate value and the mean absolute
+    activation of its hidden layer, per channel
+    """
+    sums = {"gates": {}, "hidden": {}}
+    counts = {}
+    handles = []
+
+    def make_hook(module, key):
+        def hook(_, inputs, output):
+            out = output.detach().float()
+            sums[key][module] = sums[key].get(module, 0) + out.abs().mean(dim=(2, 3)).sum(0)
+            if key == "gates":
+                counts[module] = counts.get(module, 0) + out.size(0)
+        return hook
+
+    for m in model.modules():
+        if type(m) in gate_modules:
+            seq_name, _, act, _ = gate_modules[type(m)]
+            seq = getattr(m, seq_name)
+            handles.append(seq.register_forward_hook(make_hook(m, "gates")))
+            handles.append(seq[act].register_forward_hook(make_hook(m, "hidden")))
+
+    model.eval()
+    with torch.no_grad():
+        for i, (inputs, _) in enumerate(loader):
+            if num_batches is not None and i == num_batches:
+                break
+            model(inputs.to(device))
+
+    for h in handles:
+        h.remove()
+    gates = {m: (sums["gates"][m] / counts[m]).cpu() for m in counts}
+    hidden = {m: (sums["hidden"][m] / counts[m]).cpu() for m in counts}
+    return gates, hidden
+
+
+def _lookup(gate, pos, alive):
+    # channels that get consumed by a later block never reach the gate directly, give them the average gate value
+    w = torch.full(pos.shape, gate.mean().item())
+    w[alive] = gate[pos[alive]]
+    return w
+
+
+def output_weights(items, j, stage_gate, gates):
+    """
+    Follows each branch output of items[j] through the channel shuffles until it reaches a gate.
+
+    After a block, branch output k ends up at channel 2k + 1. A BasicBlock passes channels in the first half of its
+    input straight through to 2p, and feeds the second half into its branch.
+
+    :param items: blocks in the stage, in order
+    :param j: index of the block
+    :param stage_gate: gate module applied to the output of the stage, if any(SLE)
+    :param gates: mean gate values from collect_stats
+    :return: weight of each branch output
+    """
+    n = getattr(items[j], branches[type(items[j])][5]).num_features
+    pos = torch.arange(n) * 2 + 1
+    alive = torch.ones(n, dtype=torch.bool)
+    for item in items[j + 1:]:
+        if isinstance(item, SEBlock) and item in gates:
+            return _lookup(gates[item], pos, alive)
+        if isinstance(item, BasicBlock):
+            alive &= pos < n
+            pos = torch.where(alive, pos * 2, pos)
+    if stage_gate is not None and stage_gate in gates:
+        return _lookup(gates[stage_gate], pos, alive)
+    return torch.ones(n)
+
+
+def branch_importance(block, out_weights):
+    """
+    Scores each hidden channel by how much it contributes to the gated branch output.
+    """
+    _, _, _, bn_mid, conv_out, bn_out = (getattr(block, name) for name in branches[type(block)])
+    out_scale = (bn_out.weight / torch.sqrt(bn_out.running_var + bn_out.eps)).detach().abs().cpu()
+    w = conv_out.weight.detach().abs().flatten(1).cpu()  # out x hidden
+    return bn_mid.weight.detach().abs().cpu() * ((out_weights * out_scale).unsqueeze(1) * w).sum(0)
+
+
+def gate_importance(module, hidden):
+    """
+    Scores each hidden channel of an SE/SLE module by its mean activation times its outgoing weights.
+    """
+    seq_name, _, _, conv_out = gate_modules[type(module)]
+    w = getattr(module, seq_name)[conv_out].weight.detach().abs().flatten(1).cpu()
+    return hidden * w.sum(0)
+
+
+def _num_keep(n, amount, round_to):
+    keep = math.ceil((n - int(n * amount)) / round_to) * round_to
+    return min(n, max(round_to, keep))
+
+
+def _top(scores, keep):
+    return torch.sort(torch.topk(scores, keep).indices).values
+
+
+def prune(model, gates, hidden, amount=0.5, round_to=1):
+    """
+    Removes the least important fraction(amount) of hidden channels in every block and gate module.
+
+    :param gates: mean gate values from collect_stats
+    :param hidden: mean hidden activations from collect_stats
+    :param round_to: kept channel counts are rounded up to a multiple of this
+    :return: channel config of the pruned model, see get_channel_config
+    """
+    for stage in range(3):
+        items = list(getattr(model, f'layer{stage + 1}'))
+        stage_gate = getattr(model, f'sle_{stage + 1}', None)
+        for j, item in enumerate(items):
+            if type(item) in branches:
+                scores = branch_importance(item, output_weights(items, j, stage_gate, gates))
+                prune_branch(item, _top(scores, _num_keep(len(scores), amount, round_to)))
+    for m in model.modules():
+        if type(m) in gate_modules and m in hidden:
+            scores = gate_importance(m, hidden[m])
+            prune_gate(m, _top(scores, _num_keep(len(scores), amount, round_to)))
+    return get_channel_config(model)
+
+
+def evaluate(model, loader, device):
+    model.eval()
+    correct, total = 0, 0
+    with torch.no_grad():
+        for inputs, labels in loader:
+            outputs = model(inputs.to(device))
+            c, t = top1_error(outputs, labels.to(device))
+            correct += c
+            total += t
+    return correct / total
+
+
+def finetune(model, loader, device, epochs, lr, weight_decay=1e-4):
+    loss_fn = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
+    for i in range(epochs):
+        print(f"Finetune epoch {i + 1} / {epochs}")
+        model.train(True)
+        for inputs, labels in loader:
+            optimizer.zero_grad()
+            loss = loss_fn(model(inputs.to(device)), labels.to(device))
+            loss.backward()
+            optimizer.step()
+    model.train(False)
+    return model
+
+
+def measure_latency(model, device, batch_size=64, runs=50, warmup=5):
+    """
+    :return: average time per batch in seconds, on random input
+    """
+    model.eval()
+    x = torch.randn(batch_size, 3, 32, 32, device=device)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(x)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(runs):
+            model(x)
+        if device == "cuda":
+            torch.cuda.synchronize()
+    return (time.time() - start_time) / runs
+
+
+def get_stats(model, device, test_loader, batch_size=64):
+    macs, params = get_model_complexity_info(model, (3, 32, 32), as_strings=False,
+                                             print_per_layer_stat=False, verbose=False)
+    return {"Parameters": params,
+            "MMac": macs,
+            "Latency(Batch)": measure_latency(model, device, batch_size=batch_size),
+            "top1_acc_test": evaluate(model, test_loader, device)}
+
+
+def report(stats, outputpath):
+    """
+    Writes the stats for each pruning step, with reductions relative to the original model.
+    """
+    d = pd.DataFrame(stats)
+    base = d.iloc[0]
+    for col in ["Parameters", "MMac", "Latency(Batch)"]:
+        d[f"{col}_reduction"] = 1 - d[col] / base[col]
+    d["top1_acc_change"] = d["top1_acc_test"] - base["top1_acc_test"]
+    d.to_csv(outputpath, index=False)
+    return d
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--net", type=str, required=False, default=None,
+                        help="base/se/sle, only needed for train.py checkpoints")
+    parser.add_argument("--net_size", type=float, required=False, default=None)
+    parser.add_argument("--checkpoint", type=str, required=True, help="NNNN.pth from train.py, prune.py or export.py")
+    parser.add_argument("--amount", type=float, default=0.5, help="fraction of hidden channels to remove")
+    parser.add_argument("--round_to", type=int, default=1)
+    parser.add_argument("--calib_images", type=int, default=5000)
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--finetune_epochs", type=int, default=0)
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--output", type=str, default="pruned.pth")
+    parser.add_argument("--report", type=str, default="prune_report.csv")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(device)
+
+    mean, std = (0.4914, 0.4822, 0.4465), (0.247, 0.243, 0.261)
+    transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean, std)
+    ])
+    transform_train = transforms.Compose([
+        transforms.RandomCrop(32, padding=4),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        transforms.Normalize(mean, std)
+    ])
+    calib_set = Subset(datasets.CIFAR10(root="data", train=True, download=True, transform=transform),
+                       range(args.calib_images))
+    test_set = datasets.CIFAR10(root="data", train=False, download=True, transform=transform)
+    calib_loader = DataLoader(calib_set, batch_size=args.batch_size, shuffle=False)
+    test_loader = DataLoader(test_set, batch_size=args.batch_size, shuffle=False)
+
+    ckpt = torch.load(args.checkpoint, map_location="cpu")
+    # checkpoints from prune.py/export.py know their own net
+    net = ckpt.get("net", args.net)
+    net_size = ckpt.get("net_size", args.net_size if args.net_size is not None else 1)
+    assert net in nets, f"unknown net {net}, pass one of {list(nets)}"
+    model = nets[net](net_size=net_size)
+    # and are already pruned
+    set_channel_config(model, ckpt.get("channels", {}))
+    model.load_state_dict(ckpt['mod'])
+    model = model.to(device)
+
+    stats = [{"step": "original", **get_stats(model, device, test_loader)}]
+    gates, hidden = collect_stats(model, calib_loader, device)
+    channels = prune(model, gates, hidden, amount=args.amount, round_to=args.round_to)
+    stats.append({"step": "pruned", **get_stats(model, device, test_loader)})
+
+    if args.finetune_epochs > 0:
+        train_set = datasets.CIFAR10(root="data", train=True, download=True, transform=transform_train)
+        train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, num_workers=1)
+        finetune(model, train_loader, device, args.finetune_epochs, args.lr)
+        stats.append({"step": "finetuned", **get_stats(model, device, test_loader)})
+
+    print(report(stats, args.report).transpose())
+    torch.save({"mod": model.state_dict(),
+                "channels": channels,
+                "net": net,
+                "net_size": net_size}, args.output)
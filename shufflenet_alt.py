@@ -310,6 +310,12 @@ configs = {
     }
 }
 
+nets = {
+    'base': ShuffleNetV2,
+    'se': ShuffleNetSE,
+    'sle': ShuffleNetSLE
+}
+
 
 def test(net):
     x = torch.randn(3, 3, 32, 32)
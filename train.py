@@ -3,13 +3,13 @@ import time
 
 import pandas as pd
 import torch
-import torch.optim as optim
 import torchvision
 from torch import nn
 from torch.utils.data import TensorDataset
 
 from shufflenet_alt import ShuffleNetV2, ShuffleNetSE, ShuffleNetSLE, init_params
 from util import top1_error, top3_error, plot_training_curve
+from optimizers import get_optimizer, get_scheduler
 
 mean, std = (0.4914, 0.4822, 0.4465), (0.247, 0.243, 0.261)
 
@@ -122,8 +122,15 @@ def to_df(flattened_dict):
 
 def train(model, device, batch_size, lr, beta0, beta1, weight_decay, checkpoint=None, epochs=100,
           lr_decay_rate=10, lr_decay_epochs=[], decay_patience=10, csv_path="", models_path="tmp/", plot=True,
-          print_results_every_epoch=False):
-    # lr_decay_rate will apply every lr_decay_epochs epochs
+          print_results_every_epoch=False, optimizer_name="adam", scheduler_name="step", warmup_epochs=0,
+          flat_params=True):
+    """
+    lr_decay_rate will apply every lr_decay_epochs epochs(step), or after decay_patience epochs without
+    improvement(plateau). see optimizers.get_scheduler
+
+    flat_params=True moves the model's parameters into one contiguous buffer and makes their grads views into
+    another(see optimizers.FlatParams). Don't move or cast the model(model.to(), .half()) after train() starts.
+    """
     results = None
 
     # save model info
@@ -131,19 +138,20 @@ def train(model, device, batch_size, lr, beta0, beta1, weight_decay, checkpoint=
     res_csv = f"{csv_path}{label}_results.csv"
     mod_csv = f"{csv_path}{label}_params.csv"
     model_info = {"keys": ["label", "batch_size", "lr", "beta0", "beta1", "weight_decay", "lr_decay", "lr_decay_freq",
-                           "lr_decay_patience"],
+                           "lr_decay_patience", "optimizer", "lr_scheduler", "warmup_epochs"],
                   "values": [label, batch_size, lr, beta0, beta1, weight_decay, lr_decay_rate, lr_decay_epochs,
-                             decay_patience]}
+                             decay_patience, optimizer_name, scheduler_name, warmup_epochs]}
     print(f"Saving model info to {mod_csv}")
     model_info = pd.DataFrame(model_info)
     model_info.to_csv(mod_csv, index=False)
 
     data_loaders, dataset_sizes = get_dataloaders(batch_size)
     loss_fn = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(model.parameters(), betas=(beta0, beta1), lr=lr, weight_decay=weight_decay)
-
-    # [NEW] Define a learning rate scheduler to decrease the learning rate
-    # scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=1/lr_decay_rate, patience=decay_patience)
+    optimizer = get_optimizer(model, optimizer_name, lr=lr, betas=(beta0, beta1), weight_decay=weight_decay,
+                              flat=flat_params)
+    scheduler = get_scheduler(optimizer, scheduler_name, epochs=epochs, lr_decay_rate=lr_decay_rate,
+                              lr_decay_epochs=lr_decay_epochs, decay_patience=decay_patience,
+                              warmup_epochs=warmup_epochs)
 
     # train for many epochs
     for i in range(epochs):
@@ -151,6 +159,7 @@ def train(model, device, batch_size, lr, beta0, beta1, weight_decay, checkpoint=
         print("-" * 30)
         epoch_res = run_epoch(model, loss_fn, optimizer, device, data_loaders, dataset_sizes)
         epoch_res["epoch"] = i
+        epoch_res["lr"] = optimizer.param_groups[0]["lr"]
         if print_results_every_epoch:
             print(epoch_res)
         epoch_flat = flatten_dict(epoch_res)
@@ -166,17 +175,17 @@ def train(model, device, batch_size, lr, beta0, beta1, weight_decay, checkpoint=
         # save model info
         epoch_formatted = '{:04d}'.format(i)
         torch.save({"mod": model.state_dict(),
-                    "opt": optimizer.state_dict()}, f"{models_path}{epoch_formatted}.pth")
+                    "opt": optimizer.state_dict(),
+                    "sched": scheduler.state_dict() if scheduler is not None else None},
+                   f"{models_path}{epoch_formatted}.pth")
 
         if plot:
             plot_training_curve(results, save=True, save_path=f"{csv_path}curve")
 
-        # scheduler.step(epoch_flat["loss_train"])
-
-        if i > 0 and i in lr_decay_epochs:
-            print("Decreasing LR...")
-            lr /= lr_decay_rate
-            optimizer = optim.Adam(model.parameters(), lr=lr, betas=(beta0, beta1), weight_decay=weight_decay)
+        if scheduler_name == "plateau":
+            scheduler.step(epoch_flat["loss_train"])
+        elif scheduler is not None:
+            scheduler.step()
     return results, model_info
 
 
@@ -214,6 +223,26 @@ if __name__ == "__main__":
         type=str,
         required=True
     )
+    parser.add_argument(
+        "--optimizer",
+        type=str,
+        required=False,
+        default="adam",
+        help="adam/adamw"
+    )
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        required=False,
+        default="step",
+        help="step/plateau/cosine/none"
+    )
+    parser.add_argument(
+        "--warmup_epochs",
+        type=int,
+        required=False,
+        default=0
+    )
     args = parser.parse_args()
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -237,4 +266,5 @@ if __name__ == "__main__":
     models_path = "ShuffleNetV2/models/01/"
     res_path = "ShuffleNetV2/results/01/"
     train(model, device, args.batch_size, args.lr, beta0=0.9, beta1=0.999, weight_decay=1e-4,
-          epochs=args.epochs, lr_decay_rate=10, lr_decay_epochs=[], csv_path=args.csv, models_path=args.models)
\ No newline at end of file
+          epochs=args.epochs, lr_decay_rate=10, lr_decay_epochs=[], csv_path=args.csv, models_path=args.models,
+          optimizer_name=args.optimizer, scheduler_name=args.scheduler, warmup_epochs=args.warmup_epochs)
\ No newline at end of file